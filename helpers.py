@@ -1,10 +1,132 @@
 import tempfile
+import webbrowser
+from pathlib import Path
+
 import rpy2.robjects as robjects
-from rpy2.robjects.packages import importr
 from rpy2.robjects.conversion import localconverter
 
-from io import BytesIO
-from PIL import Image
+from IPython.display import Image as IPyImage
+
+# R functions below are defined and byte-compiled once at import, and called with
+# arguments from Python so no R code is parsed per plot.
+
+# R function that renders a plot function to a PNG and returns it as a raw vector.
+# Extra arguments are passed to plot_fn; set print_plot = FALSE for plot functions
+# that draw to the device themselves rather than returning a ggplot object.
+robjects.r('''
+.geolift_render <- compiler::cmpfun(function(plot_fn, ..., print_plot = TRUE, bg = "transparent",
+                                            width = 800L, height = 600L) {
+  temp_file <- tempfile(fileext = ".png")
+  on.exit(unlink(temp_file), add = TRUE)
+
+  grDevices::png(temp_file, width = width, height = height, pointsize = 16L, bg = bg)
+  tryCatch({
+    p <- plot_fn(...)
+    if (print_plot) print(p)
+  }, finally = grDevices::dev.off())
+
+  base::readBin(temp_file, what = "raw", n = file.info(temp_file)$size)
+})
+''')
+
+# R functions that create diagnostic table power_data and plot it, for one
+# treatment combination or for several at once in a single call
+robjects.r('''
+.deep_dive <- compiler::cmpfun(function(market_id, lookback_window) {
+  market_row <- MarketSelections$BestMarkets %>% dplyr::filter(ID == market_id)
+  treatment_locations <- stringr::str_split(market_row$location, ", ")[[1]]
+  treatment_duration <- market_row$duration
+
+  power_data <- GeoLiftPower(
+    data = GeoTestData_PreTest,
+    locations = treatment_locations,
+    effect_size = seq(-0.25, 0.25, 0.01),
+    lookback_window = lookback_window,
+    treatment_periods = treatment_duration,
+    cpic = 7.5,
+    side_of_test = "two_sided",
+    parallel = TRUE,
+    parallel_setup = "sequential"
+    )
+
+  plot(power_data, show_mde = TRUE, smoothed_values = FALSE, breaks_x_axis = 5) +
+    ggplot2::labs(caption = unique(power_data$location))
+})
+
+.deep_dive_batch <- compiler::cmpfun(function(market_ids, lookback_windows) {
+  Map(function(market_id, lookback_window) .geolift_render(.deep_dive, market_id, lookback_window),
+      market_ids, lookback_windows)
+})
+''')
+
+# R functions that plot power analysis diagnostics for a single cell and for
+# multiple cells, with cells and Market IDs in an R list
+robjects.r('''
+.market_plot <- compiler::cmpfun(function(market_id) {
+  plot(MarketSelections, market_ID = market_id, print_summary = TRUE)
+})
+
+.market_plot_multicell <- compiler::cmpfun(function(market_ids) {
+  test_locs <- stats::setNames(as.list(market_ids), paste0("cell_", seq_along(market_ids)))
+  plot(Markets, test_markets = test_locs, type = "Lift", stacked = TRUE)
+})
+
+.deep_dive_multicell <- compiler::cmpfun(function(market_ids, lookback_window) {
+  test_locs <- stats::setNames(as.list(market_ids), paste0("cell_", seq_along(market_ids)))
+
+  Power <- MultiCellPower(Markets,
+                          test_markets = test_locs,
+                          effect_size =  seq(-0.5, 0.5, 0.05),
+                          lookback_window = lookback_window,
+                          parallel = TRUE,
+                          parallel_setup = "sequential")
+
+  plot(Power, actual_values = TRUE, thed_values = FALSE, show_mde = TRUE, breaks_x_axis = 15, stacked = TRUE)
+})
+''')
+
+
+def _render_png(plot_fn, *args, print_plot=True, bg="transparent"):
+    '''
+    Renders an R plot function to PNG bytes via .geolift_render
+
+    Args:
+        plot_fn (R function obj): R function that creates the plot
+        *args (R vector objs): arguments passed to plot_fn
+        print_plot (bool): Default True prints the ggplot object returned by plot_fn.
+                           Set to False when plot_fn draws the plot itself
+        bg (str): background color of the png device
+
+    Returns:
+        PNG image bytes
+    '''
+
+    with localconverter(robjects.default_converter):
+        raw_vector = robjects.r['.geolift_render'](plot_fn, *args, print_plot=print_plot, bg=bg)
+
+        # Convert the R raw vector to Python bytes
+        return bytes(raw_vector)
+
+
+def _show_png(img_data, inline=True):
+    '''
+    Shows PNG bytes rendered by R either inline or in a .png file
+
+    Args:
+        img_data (bytes): PNG image bytes, e.g. bytes() of an R raw vector
+        inline (bool): Default True shows plots inline in ipython notebooks.
+                       Set to False to output .png files
+    '''
+
+    if inline == True:
+        # display the PNG bytes inline in jupyter/ipython, no decode needed
+        display(IPyImage(data=img_data, format='png'))
+    else:
+        # write the PNG bytes as-is to a .png file and open it in the default viewer,
+        # where it can be saved
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmpfile:
+            tmpfile.write(img_data)
+        webbrowser.open(Path(tmpfile.name).as_uri())
 
 
 def make_geoplot(r, plot_R_code, inline=True):
@@ -26,52 +148,15 @@ def make_geoplot(r, plot_R_code, inline=True):
         R plot specified in first arg
     '''
 
-    with localconverter(robjects.default_converter):
-        
-        # Import R's base package
-        base = importr('base')
-
-        # Define the R function to create and capture the plot        
-        r('''
-        create_plot <- function() {
-
-          # Create the plot
-          p <- ''' + plot_R_code + '''
-
-          # Open a png device in memory
-          grDevices::png(tempfile(), bg = "transparent")
-          print(p)
-          grDevices::dev.off()
-
-          # Read the file and return its content
-          temp_file <- tempfile()
-          grDevices::png(temp_file, width=800, height=600, pointsize=16, bg="transparent")
-          print(p)
-          grDevices::dev.off()
-
-          raw_vector <- base::readBin(temp_file, what = "raw", n = file.info(temp_file)$size)
-          unlink(temp_file) # Remove the temp file
-          return(raw_vector)
-        }
-        ''')
-
-        # Call the R function
-        raw_vector = robjects.r['create_plot']()
-        
-        # Convert the R raw vector to Python bytes
-        img_data = bytes(raw_vector)
-
-        # Use BytesIO to handle the image data
-        img_buffer = BytesIO(img_data)
-
-        # Open the image using PIL
-        img = Image.open(img_buffer)
+    # Define the R function to create the plot
+    plot_fn = r('''
+    function() {
+      ''' + plot_R_code + '''
+    }
+    ''')
 
-        # Display the image 
-        if inline == True:
-            display(img)  # display image inline in jupyter/ipython
-        else:
-            img.show()  # img.show() outputs a .png popup that can be saved
+    # Render the plot and display the image
+    _show_png(_render_png(plot_fn), inline)
 
 
 def make_market_plot(r, market_id, inline=True):
@@ -89,27 +174,11 @@ def make_market_plot(r, market_id, inline=True):
         R plot for power analysis diagnostic
     '''
 
-    with localconverter(robjects.default_converter):
-        
-        # Create a temporary file to save the plot
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmpfile:
-            tmpfile_name = tmpfile.name
-
-        # Run the R plotting command and save the plot to the temporary file
-        r(f'''
-        png(filename="{tmpfile_name}", width=800, height=600, pointsize=16)
-        plot(MarketSelections, market_ID = {market_id}, print_summary = TRUE)
-        dev.off()
-        ''')
-
-        # Open the saved image using Pillow and return the image object
-        img = Image.open(tmpfile_name)
-        
-        # Display the image
-        if inline == True:
-            display(img)
-        else:
-            img.show()
+    # Render the plot and display the image
+    img_data = _render_png(robjects.r['.market_plot'],
+                           robjects.IntVector([market_id]),
+                           print_plot=False, bg="white")
+    _show_png(img_data, inline)
 
 
 def make_market_deep_dive_plot(r, market_id, lookback_window, inline=True):
@@ -135,32 +204,44 @@ def make_market_deep_dive_plot(r, market_id, lookback_window, inline=True):
         R plot for power analysis diagnostic
     '''
 
-    # R code to create diagnostic table power_data
-    r(f'''
-        market_id = {market_id}
-        market_row <- MarketSelections$BestMarkets %>% dplyr::filter(ID == market_id)
-        treatment_locations <- stringr::str_split(market_row$location, ", ")[[1]]
-        treatment_duration <- market_row$duration
-        lookback_window <- {lookback_window}
-
-        power_data <- GeoLiftPower(
-          data = GeoTestData_PreTest,
-          locations = treatment_locations,
-          effect_size = seq(-0.25, 0.25, 0.01),
-          lookback_window = lookback_window,
-          treatment_periods = treatment_duration,
-          cpic = 7.5,
-          side_of_test = "two_sided"
-          )
-    ''')
+    # Render the plot and display the image. The ggplot object is printed inside R
+    # as a workaround for bug documented here:
+    # github.com/tidyverse/ggplot2/issues/2514
+    img_data = _render_png(robjects.r['.deep_dive'],
+                           robjects.IntVector([market_id]),
+                           robjects.IntVector([lookback_window]))
+    _show_png(img_data, inline)
 
-    # R code for plot
-    p = '''plot(power_data, show_mde = TRUE, smoothed_values = FALSE, breaks_x_axis = 5) +
-                ggplot2::labs(caption = unique(power_data$location))'''
 
-    # invoking make_geoplot as a workaround for bug documented here:
-    # github.com/tidyverse/ggplot2/issues/2514
-    make_geoplot(r, p)
+def make_market_deep_dive_plot_batch(r, market_ids, lookback_windows, inline=True):
+    '''
+    Shows power analysis curves from Meta GeoLift for several treatment combinations,
+    either inline or in .png files, rendering them all in a single call to R.
+    See make_market_deep_dive_plot for a single treatment combination.
+
+    Args:
+        r (R instance obj): R instance from r = robjects.r
+        market_ids (list of ints): numbers from MarketSelections table ID col, one per plot
+        lookback_windows (list of ints): number of periods for lookback window for each
+                                         market_id in market_ids
+        inline (bool): Default True shows plots inline in ipython notebooks.
+                       Set to False to output .png files
+
+    Returns:
+        R plots for power analysis diagnostic, one per market_id
+    '''
+
+    if len(market_ids) != len(lookback_windows):
+        raise ValueError("market_ids and lookback_windows must be the same length")
+
+    # Render all plots in R, then display each image
+    with localconverter(robjects.default_converter):
+        raw_vectors = robjects.r['.deep_dive_batch'](robjects.IntVector(market_ids),
+                                                     robjects.IntVector(lookback_windows))
+        img_datas = [bytes(raw_vector) for raw_vector in raw_vectors]
+
+    for img_data in img_datas:
+        _show_png(img_data, inline)
 
 
 def make_market_plot_multicell(r, market_ids, inline=True):
@@ -178,33 +259,11 @@ def make_market_plot_multicell(r, market_ids, inline=True):
         R plot for power analysis diagnostic
     '''
 
-    with localconverter(robjects.default_converter):
-        
-        # Cells and Market IDs in an R list
-        market_locs = ", ".join("cell_{} = {}".format(i+1, n) for i, n in enumerate(market_ids))
-        r(f'''
-        test_locs <- list({market_locs})
-        ''')
-
-        # Create a temporary file to save the plot
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmpfile:
-            tmpfile_name = tmpfile.name
-
-        # Run the R plotting command and save the plot to the temporary file
-        r(f'''
-        png(filename="{tmpfile_name}", width=800, height=600, pointsize=16)
-        plot(Markets, test_markets = test_locs, type = "Lift", stacked = TRUE)
-        dev.off()
-        ''')
-
-        # Open the saved image using Pillow and return the image object
-        img = Image.open(tmpfile_name)
-        
-        # Display the image
-        if inline == True:
-            display(img)
-        else:
-            img.show()
+    # Render the plot and display the image
+    img_data = _render_png(robjects.r['.market_plot_multicell'],
+                           robjects.IntVector(market_ids),
+                           print_plot=False, bg="white")
+    _show_png(img_data, inline)
 
 
 def make_market_deep_dive_plot_multicell(r, market_ids, lookback_window, inline=True):
@@ -230,37 +289,9 @@ def make_market_deep_dive_plot_multicell(r, market_ids, lookback_window, inline=
         R plot for power analysis diagnostic
     '''
 
-    # Cells and Market IDs in an R list
-    market_locs = ", ".join("cell_{} = {}".format(i+1, n) for i, n in enumerate(market_ids))
-    r(f'''
-    test_locs <- list({market_locs})
-    ''')
-
-    # R code to create diagnostic table
-    r(f'''
-        Power <- MultiCellPower(Markets,
-                                test_markets = test_locs,
-                                effect_size =  seq(-0.5, 0.5, 0.05),
-                                lookback_window = {lookback_window})
-    ''')
-
-    with localconverter(robjects.default_converter):
-        # Create a temporary file to save the plot
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmpfile:
-            tmpfile_name = tmpfile.name
-
-        # Run the R plotting command and save the plot to the temporary file
-        r(f'''
-        png(filename="{tmpfile_name}", width=800, height=600, pointsize=16)
-        plot(Power, actual_values = TRUE, thed_values = FALSE, show_mde = TRUE, breaks_x_axis = 15, stacked = TRUE)
-        dev.off()
-        ''')
-
-        # Open the saved image using Pillow and return the image object
-        img = Image.open(tmpfile_name)
-
-        # Display the image
-        if inline == True:
-            display(img)
-        else:
-            img.show()
+    # Render the plot and display the image
+    img_data = _render_png(robjects.r['.deep_dive_multicell'],
+                           robjects.IntVector(market_ids),
+                           robjects.IntVector([lookback_window]),
+                           print_plot=False, bg="white")
+    _show_png(img_data, inline)